@@ -2,7 +2,438 @@
 """
 Work with ctags file
 """
+import os
+import re
+import sys
+import mmap
 import time  # profiling
+import bisect
+from array import array
+
+# first line of shards manifest file
+MANIFEST_HEADER = '!_SERPENTARIUM_SHARDS'
+
+# python definition line, for fast scan of unsaved sources
+DEFINITION_RE = re.compile(r'^([ \t]*)(def|class)[ \t]+(\w+)', re.M)
+
+
+class NameDictionary(object):
+    """
+    Sorted list of unique names, front-coded by blocks
+    """
+    # names count in one block
+    block_size = 16
+
+    # shared prefix length is stored as one char, shifted away from '\n'
+    _shift = 32
+
+    def __init__(self, names=()):
+        """
+        Initialize with sorted unique names
+        """
+        # first name of each block - sampled index for binary search
+        self._heads = []
+        # rest names of each block: shared prefix length char + suffix
+        self._blocks = []
+        self._length = 0
+
+        tail = []
+        previous = None
+        for name in names:
+            if self._length % self.block_size == 0:
+                # start new block
+                if previous is not None:
+                    self._blocks.append(u'\n'.join(tail))
+                self._heads.append(name)
+                tail = []
+            else:
+                # store only the part which differs from previous name
+                shared = 0
+                limit = min(len(previous), len(name),
+                            0xFFFF - self._shift)
+                while shared < limit and previous[shared] == name[shared]:
+                    shared += 1
+                tail.append(unichr(shared + self._shift) + name[shared:])
+
+            previous = name
+            self._length += 1
+
+        if previous is not None:
+            self._blocks.append(u'\n'.join(tail))
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        """
+        Get name by index
+        """
+        if index < 0:
+            index += self._length
+        if not 0 <= index < self._length:
+            raise IndexError(index)
+        return self._decode(index // self.block_size)[index % self.block_size]
+
+    def _decode(self, block):
+        """
+        Decompress all names of given block
+        """
+        name = self._heads[block]
+        names = [name]
+
+        tail = self._blocks[block]
+        if tail:
+            for entry in tail.split(u'\n'):
+                name = name[:ord(entry[0]) - self._shift] + entry[1:]
+                names.append(name)
+        return names
+
+    def _lower_bound(self, name):
+        """
+        Get index of first name which is not less than given name
+        """
+        block = bisect.bisect_left(self._heads, name)
+        if block == 0:
+            return 0
+
+        # name is between previous block head and current block head
+        block -= 1
+        names = self._decode(block)
+        return block * self.block_size + bisect.bisect_left(names, name)
+
+    def find(self, name):
+        """
+        Get index of given name, -1 if not found
+        """
+        index = self._lower_bound(name)
+        if index < self._length and self[index] == name:
+            return index
+        return -1
+
+    def prefix_range(self, prefix):
+        """
+        Get indexes range of names starting with given prefix
+        """
+        return (self._lower_bound(prefix),
+                self._lower_bound(prefix + unichr(sys.maxunicode)))
+
+    def slice(self, start, stop):
+        """
+        Get names list in given indexes range
+        """
+        names = []
+        block = start // self.block_size
+        skip = start % self.block_size
+        while len(names) < stop - start:
+            names.extend(self._decode(block)[skip:])
+            block += 1
+            skip = 0
+        return names[:stop - start]
+
+
+def parse_address(tagaddress):
+    """
+    Get search pattern from ctags address: (pattern, is anchored to end)
+    """
+    # strip ';"' suffix, used for extension fields
+    if tagaddress.endswith(';"'):
+        tagaddress = tagaddress[:-2]
+
+    # address is not a search pattern, e.g. line number
+    if len(tagaddress) < 2 or tagaddress[0] not in '/?' or \
+            tagaddress[-1] != tagaddress[0]:
+        return None, False
+    pattern = tagaddress[1:-1]
+
+    if pattern.startswith('^'):
+        pattern = pattern[1:]
+    anchored = pattern.endswith('$') and not pattern.endswith('\\$')
+    if anchored:
+        pattern = pattern[:-1]
+
+    # unescape delimiter and backslashes
+    pattern = pattern.replace('\\' + tagaddress[0], tagaddress[0])
+    pattern = pattern.replace('\\\\', '\\')
+
+    return pattern.encode('utf-8'), anchored
+
+
+def find_line(source, pattern, anchored, line):
+    """
+    Find line number of pattern in mmaped source, nearest to given line
+    """
+    def matches(offset):
+        # check line at given offset starts with pattern
+        if source[offset:offset + len(pattern)] != pattern:
+            return False
+        if anchored:
+            return source[offset + len(pattern):
+                          offset + len(pattern) + 1] in ('', '\n', '\r')
+        return True
+
+    # get offset of given line
+    start = 0
+    for _ in xrange(line - 1):
+        start = source.find('\n', start)
+        if start == -1:
+            start = len(source)
+            break
+        start += 1
+
+    if matches(start):
+        return line
+
+    # search forward and backward from given line for nearest match
+    needle = '\n' + pattern
+    forward = source.find(needle, start)
+    while forward != -1 and not matches(forward + 1):
+        forward = source.find(needle, forward + 1)
+    if forward != -1:
+        forward += 1
+
+    backward = source.rfind(needle, 0, start - 2 + len(needle))
+    while backward != -1 and not matches(backward + 1):
+        backward = source.rfind(needle, 0, backward - 1 + len(needle))
+    if backward != -1:
+        backward += 1
+    elif start > 0 and matches(0):
+        # first line is not preceded by line break
+        backward = 0
+
+    if forward == -1 and backward == -1:
+        return None
+    if forward == -1 or (backward != -1 and
+                         start - backward <= forward - start):
+        offset = backward
+    else:
+        offset = forward
+
+    return source[:offset].count('\n') + 1
+
+
+def scan_source(source, filename):
+    """
+    Find definitions in python source and return it as ctags lines
+    """
+    lines = []
+
+    # enclosing definitions: (indent, kind, name)
+    scopes = []
+
+    line = 1
+    last = 0
+    for match in DEFINITION_RE.finditer(source):
+        line += source.count(u'\n', last, match.start())
+        last = match.start()
+
+        indent, keyword, name = match.groups()
+        indent = len(indent.expandtabs())
+        while scopes and scopes[-1][0] >= indent:
+            scopes.pop()
+
+        # the same kinds and scope fields as ctags uses for python
+        if keyword == 'class':
+            kind = 'c'
+        elif scopes and scopes[-1][1] == 'c':
+            kind = 'm'
+        else:
+            kind = 'f'
+        fields = ['kind:%s' % kind, 'line:%d' % line]
+        if scopes:
+            fields.append('%s:%s' % (
+                'class' if scopes[-1][1] == 'c' else 'function',
+                '.'.join(scope[2] for scope in scopes),
+            ))
+
+        # search pattern with escaped delimiter and backslashes
+        end = source.find(u'\n', match.start())
+        text = source[match.start():end if end != -1 else len(source)]
+        address = u'/^%s$/;"' % text.rstrip(u'\r').replace(
+            u'\\', u'\\\\'
+        ).replace(u'/', u'\\/')
+
+        lines.append(u'\t'.join([name, filename, address] + fields)
+                     .encode('utf-8'))
+        scopes.append((indent, kind, name))
+
+    return lines
+
+
+def sort_roots(roots):
+    """
+    Normalize roots list, nested roots go first
+    """
+    return sorted(
+        (os.path.normpath(r).rstrip(os.sep) for r in roots or ()),
+        key=len, reverse=True
+    )
+
+
+def get_shard(tagfile, roots):
+    """
+    Get shard for file: shard directory and is it recursive
+
+    Each top-level directory of project root (or include dir) is a shard,
+    files right in the root are a non-recursive shard of root itself.
+    """
+    for root in sort_roots(roots):
+        if tagfile.startswith(root + os.sep):
+            path = tagfile[len(root) + 1:]
+            if os.sep in path:
+                return os.path.join(root, path.split(os.sep, 1)[0]), True
+            return root, False
+    return os.path.dirname(tagfile), False
+
+
+def is_manifest(tags_file):
+    """
+    Check if tags file is a shards manifest
+    """
+    try:
+        with open(tags_file, 'r') as f:
+            return f.readline().startswith(MANIFEST_HEADER)
+    except IOError:
+        return False
+
+
+def read_manifest(manifest_file, with_names=True):
+    """
+    Read shards manifest: shards list and sorted list of names with its
+    shards ids
+
+    Shard is a tuple: (directory, is recursive, tags filename, tags count).
+    """
+    shards = []
+    names = []
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            line = line.rstrip('\r\n')
+            if line.startswith('!_SHARD\t'):
+                _, path, recursive, filename, count = line.split('\t')
+                shards.append((path.decode('utf-8'), recursive == '1',
+                               filename, int(count)))
+            elif not line or line.startswith('!_'):
+                continue
+            elif not with_names:
+                # shards are listed before names
+                break
+            else:
+                name, ids = line.split('\t')
+                names.append((name.decode('utf-8'),
+                              [int(i) for i in ids.split(',')]))
+    return shards, names
+
+
+def write_manifest(manifest_file, shards, names):
+    """
+    Write shards manifest, names is a dict: name -> set of shards ids
+
+    Removed shards are None in shards list, so shards ids are compacted.
+    """
+    lines = [MANIFEST_HEADER + '\t1\n']
+
+    remap = {}
+    for i, shard in enumerate(shards):
+        if shard is None:
+            continue
+        remap[i] = len(remap)
+        path, recursive, filename, count = shard
+        lines.append('!_SHARD\t%s\t%d\t%s\t%d\n' % (
+            path.encode('utf-8'), recursive, filename, count
+        ))
+
+    for name in sorted(names):
+        ids = sorted(remap[i] for i in names[name] if i in remap)
+        if ids:
+            lines.append('%s\t%s\n' % (name.encode('utf-8'),
+                                        ','.join(str(i) for i in ids)))
+
+    with open(manifest_file, 'w') as f:
+        f.writelines(lines)
+
+
+def read_names(names_file):
+    """
+    Read sorted unique names, one per line
+    """
+    with open(names_file, 'r') as f:
+        return [line.rstrip('\r\n').decode('utf-8') for line in f]
+
+
+def write_names(names_file, tags_file):
+    """
+    Write sorted unique names of ctags file, one per line
+    """
+    names = set()
+    with open(tags_file, 'r') as f:
+        for line in f:
+            # skip empty lines and ctags comments
+            if not line.strip() or line.startswith('!_'):
+                continue
+            names.add(line.split('\t', 1)[0])
+
+    # utf-8 bytes order is the same as unicode names order
+    with open(names_file, 'w') as f:
+        f.writelines(name + '\n' for name in sorted(names))
+
+
+def split_tags(lines, shards_dir, roots, generation, shards, names):
+    """
+    Write ctags lines into new shards files, update shards list and names
+
+    Lines of existing shard go to new file of that shard, so shard must be
+    removed from shards list (set to None) before it will be rewritten.
+    """
+    if not os.path.isdir(shards_dir):
+        os.makedirs(shards_dir)
+
+    # existing shards ids
+    index = dict(((shard[0], shard[1]), i)
+                 for i, shard in enumerate(shards) if shard is not None)
+
+    files = {}
+    counts = {}
+    keys = {}
+    file_shards = {}
+    try:
+        for line in lines:
+            # skip empty lines and ctags comments
+            if not line.strip() or line.startswith('!_'):
+                continue
+            tagname, tagfile, _ = line.split('\t', 2)
+
+            shard_id = file_shards.get(tagfile)
+            if shard_id is None:
+                key = get_shard(tagfile.decode('utf-8'), roots)
+                shard_id = index.get(key)
+                if shard_id is None:
+                    # new shard
+                    shard_id = index[key] = len(shards)
+                    shards.append(None)
+                if shard_id not in files:
+                    filename = "%d.%d.ctags" % (shard_id, generation)
+                    files[shard_id] = open(
+                        os.path.join(shards_dir, filename), 'w'
+                    )
+                    counts[shard_id] = 0
+                    keys[shard_id] = key
+                file_shards[tagfile] = shard_id
+
+            if not line.endswith('\n'):
+                line += '\n'
+            files[shard_id].write(line)
+            counts[shard_id] += 1
+            names.setdefault(tagname.decode('utf-8'), set()).add(shard_id)
+    finally:
+        # don't leave partly written shards files open
+        for f in files.values():
+            f.close()
+
+    for shard_id, f in files.items():
+        shards[shard_id] = keys[shard_id] + (os.path.basename(f.name),
+                                             counts[shard_id])
+
+    return shards, names
 
 
 class CTags(object):
@@ -10,14 +441,38 @@ class CTags(object):
     Work with ctags file
     """
 
-    def __init__(self, tags_file=None, debug=False):
+    def __init__(self, tags_file=None, roots=None, base_dir=None,
+                 generation=0, debug=False):
         """
         Initialize
         """
-        # this is for ctags list
+        # this is for ctags list, sorted by name
         self._tags = None
         self._debug = debug
 
+        # tags names: compressed dictionary of unique names and tags range
+        # for each name, name is stored in tag as index in this dictionary
+        self._names = NameDictionary()
+        self._offsets = array('l', [0])
+
+        # per-file index: tags indexes sorted by file and line, its lines
+        # and tags range for each file
+        self._by_file = array('l')
+        self._lines = array('l')
+        self._files = {}
+
+        # tags build number, newer index has greater generation
+        self.generation = generation
+
+        # dir for relative paths in tags file
+        self._base_dir = base_dir
+
+        # tags of third-party packages, merged into lookups results
+        self._packages = []
+
+        # project roots, used to build nice paths for display rows
+        self._roots = sort_roots(roots)
+
         if tags_file is not None:
             # load ctags if ctags file given
             self.load_file(tags_file)
@@ -26,15 +481,21 @@ class CTags(object):
         """
         Load or reload tags from ctags file
         """
-        if self._debug:  # profiling
-            timing = time.time()
-
         try:
             # read ctags file and get all lines from file
             all_tags = tuple(l.strip() for l in open(tags_file, 'r'))
         except IOError:
             return False
 
+        self.load_lines(all_tags)
+
+    def load_lines(self, all_tags):
+        """
+        Load or reload tags from ctags lines
+        """
+        if self._debug:  # profiling
+            timing = time.time()
+
         tags = list()
         for tag_line in all_tags:
             # skip empty lines and ctags comments
@@ -71,40 +532,233 @@ class CTags(object):
                 tagfields = {}
 
             # append parsed tagfield into tags list
+            tagfile = tagfile.decode('utf-8')
+            if self._base_dir is not None:
+                tagfile = os.path.join(self._base_dir, tagfile)
+            tagline = int(tagfields.get('line', 0))
+            tagaddress = tagaddress.decode('utf-8')
             tags.append((
                 tagname.decode('utf-8'),
-                tagfile.decode('utf-8'),
-                int(tagfields.get('line', 0)),
-                tagaddress.decode('utf-8'),
-                tagfields
+                tagfile,
+                tagline,
+                tagaddress,
+                tagfields,
+                self.display_row(tagfile, tagline, tagaddress),
             ))
+
+        # sort tags by name (ctags file is mostly sorted already) and
+        # replace names with its index in names dictionary
+        tags.sort(key=lambda tag: tag[0])
+        names = []
+        offsets = array('l')
+        for i, tag in enumerate(tags):
+            if not names or names[-1] != tag[0]:
+                names.append(tag[0])
+                offsets.append(i)
+            tags[i] = (len(names) - 1,) + tag[1:]
+        offsets.append(len(tags))
+
+        # sort tags by file and line for per-file index
+        order = sorted(xrange(len(tags)), key=lambda i: tags[i][1:3])
+        files = {}
+        for pos, i in enumerate(order):
+            start, stop = files.get(tags[i][1], (pos, pos))
+            files[tags[i][1]] = (start, pos + 1)
+
         self._tags = tags
+        self._names = NameDictionary(names)
+        self._offsets = offsets
+        self._by_file = array('l', order)
+        self._lines = array('l', (tags[i][2] for i in order))
+        self._files = files
 
         if self._debug:  # profiling
             timing = (time.time() - timing) * 1000
             print "[ctags] rebuild: %.02fms" % timing
 
-    def get_definitions(self, symbol=None):
+    def prettify_path(self, path):
         """
-        Find all definitions of word under a cursor and return list of it
+        Makes file path nice to show to user
+        """
+        for root in self._roots:
+            if path.startswith(root + os.sep):
+                # + 1 for slash
+                return path[len(root) + 1:]
+        return path
+
+    def display_row(self, tagfile, tagline, tagaddress):
+        """
+        Build quick panel row for tag: signature and path with line number
+        """
+        return (
+            tagaddress[2:-4].strip(),
+            u"%d: %s" % (tagline, self.prettify_path(tagfile)),
+        )
+
+    def add_package(self, tags):
+        """
+        Add third-party package tags to lookups
+        """
+        self._packages.append(tags)
+
+    def _replace(self, tag, updated):
+        """
+        Replace tag in index, return False if tag is not from this index
+        """
+        # tag is stored in names range, replace it there, tag may be from
+        # other load of the same tags file, so compare by value
+        if 0 <= tag[0] < len(self._offsets) - 1:
+            for i in xrange(self._offsets[tag[0]],
+                            self._offsets[tag[0] + 1]):
+                if self._tags[i] == tag:
+                    self._tags[i] = updated
+                    self._sort_file(updated[1])
+                    return True
+        return False
+
+    def _sort_file(self, filename):
+        """
+        Sort file tags range in per-file index by line
+        """
+        start, stop = self._files[filename]
+        order = sorted(self._by_file[start:stop],
+                       key=lambda i: self._tags[i][2])
+        self._by_file[start:stop] = array('l', order)
+        self._lines[start:stop] = array('l', (self._tags[i][2]
+                                              for i in order))
+
+    def _file_index(self, filename, load=True):
+        """
+        Get index with tags of given file
+        """
+        if filename in self._files:
+            return self
+
+        # package tags may be not loaded yet
+        for package in self._packages:
+            index = package._file_index(filename, load)
+            if index is not None:
+                return index
+        return None
+
+    def get_file_symbols(self, filename):
+        """
+        Get all tags of file, sorted by line
+        """
+        index = self._file_index(filename)
+        if index is None:
+            return []
+
+        start, stop = index._files[filename]
+        return [index._tags[i] for i in index._by_file[start:stop]]
+
+    def get_enclosing(self, filename, line, indent=0, load=True):
+        """
+        Get name of definition which encloses given line of file, indent
+        is the line indentation (with tabs expanded)
+
+        If load is False, only already loaded tags are used.
+        """
+        index = self._file_index(filename, load)
+        if index is None:
+            return None
+
+        # last definition in file before given line
+        start, stop = index._files[filename]
+        pos = bisect.bisect_right(index._lines, line, start, stop) - 1
+
+        # walk back past definitions which are over before given line:
+        # enclosing definition is indented less than the line
+        while pos >= start:
+            tag = index._tags[index._by_file[pos]]
+            if tag[2] == line:
+                break
+            pattern = tag[3][2:].expandtabs()
+            if len(pattern) - len(pattern.lstrip()) < indent:
+                break
+            pos -= 1
+        if pos < start:
+            return None
+
+        # prepend definition scope, e.g. class for methods
+        name = index._names[tag[0]]
+        scope = tag[4].get('class') or tag[4].get('function')
+        if scope:
+            name = u"%s.%s" % (scope.decode('utf-8'), name)
+        return name
+
+    def update_line(self, tag, line):
+        """
+        Set new line number for tag in index
+        """
+        updated = tag[:2] + (line,) + tag[3:5] + (
+            self.display_row(tag[1], line, tag[3]),
+        ) + tag[6:]
+
+        for index in [self] + self._packages:
+            if index._replace(tag, updated):
+                break
+
+        return updated
+
+    def reanchor(self, tag):
+        """
+        Check tag line with tag search pattern, fix it if file was changed
         """
         if self._debug:  # profiling
             timing = time.time()
 
-        definitions = []
+        pattern, anchored = parse_address(tag[3])
+        if not pattern:
+            return tag
+
+        try:
+            with open(tag[1], 'rb') as f:
+                source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # file is not found or empty
+            return tag
+
+        try:
+            line = find_line(source, pattern, anchored, tag[2])
+        finally:
+            source.close()
+
+        if line is not None and line != tag[2]:
+            tag = self.update_line(tag, line)
 
+        if self._debug:  # profiling
+            timing = (time.time() - timing) * 1000
+            print "[ctags] reanchor: %.02fms" % timing
+
+        return tag
+
+    def _lookup(self, symbol=None):
+        """
+        Find all definitions of symbol in this index, all tags if no symbol
+        """
         if symbol is None:
             # return all tags
-            definitions = self._tags
-        else:
-            # check all tags and search for given symbol
-            found = False
-            for tag in self._tags:
-                if tag[0] == symbol:
-                    definitions.append(tag)
-                    found = True
-                elif found:
-                    break
+            return self._tags or []
+
+        # search for given symbol in names dictionary
+        index = self._names.find(symbol)
+        if index == -1:
+            return []
+        return self._tags[self._offsets[index]:self._offsets[index + 1]]
+
+    def get_definitions(self, symbol=None):
+        """
+        Find all definitions of word under a cursor and return list of it
+        """
+        if self._debug:  # profiling
+            timing = time.time()
+
+        definitions = self._lookup(symbol)
+
+        # merge third-party packages definitions
+        for package in self._packages:
+            definitions = definitions + package.get_definitions(symbol)
 
         if self._debug:  # profiling
             timing = (time.time() - timing) * 1000
@@ -119,24 +773,227 @@ class CTags(object):
         if self._debug:  # profiling
             timing = time.time()
 
-        completions = []
-        found = False
-
-        # check all tags and search for given prefix
-        for tag in self._tags:
-            if tag[0].startswith(prefix):
-                completions.append([tag[0]])
-                found = True
-            elif found:
-                break
+        # names are sorted and unique - just take names range for prefix
+        start, stop = self._names.prefix_range(prefix)
 
         # prepare completions list for sublime
-        completions = [(i, i) for sublist in completions for i in sublist]
-        completions = list(set(completions))
-        completions.sort()
+        completions = [(i, i) for i in self._names.slice(start, stop)]
+
+        # merge third-party packages completions
+        if self._packages:
+            for package in self._packages:
+                completions.extend(package.autocomplete(prefix))
+            completions = sorted(set(completions))
 
         if self._debug:  # profiling
             timing = (time.time() - timing) * 1000
             print "[ctags] autocomplete: %.02fms" % timing
 
         return completions
+
+
+class ShardedCTags(CTags):
+    """
+    Work with ctags index, sharded by project directories
+    """
+
+    def __init__(self, tags_file=None, roots=None, generation=0,
+                 cache_size=500000, debug=False):
+        """
+        Initialize
+        """
+        # shards list from manifest and loaded shards
+        self._shards = []
+        self._shards_dir = None
+        self._shard_ids = array('H')
+        self._shard_index = {}
+        self._loaded = {}
+        self._lru = []
+
+        # max tags count in loaded shards
+        self._cache_size = cache_size
+
+        super(ShardedCTags, self).__init__(tags_file, roots=roots,
+                                           generation=generation, debug=debug)
+
+    def load_file(self, tags_file, shards_dir=None):
+        """
+        Load or reload shards manifest, shards are loaded on demand
+
+        Shards are in "<tags_file>.shards" dir, unless other dir is given.
+        """
+        if self._debug:  # profiling
+            timing = time.time()
+
+        try:
+            shards, names = read_manifest(tags_file)
+        except IOError:
+            return False
+
+        # names dictionary from manifest, shards ids range for each name
+        shard_ids = array('H')
+        offsets = array('l')
+        for name, ids in names:
+            offsets.append(len(shard_ids))
+            shard_ids.extend(ids)
+        offsets.append(len(shard_ids))
+
+        self._shards = shards
+        self._shards_dir = shards_dir or tags_file + '.shards'
+        self._shard_index = dict(((shard[0], shard[1]), i)
+                                 for i, shard in enumerate(shards))
+        self._shard_ids = shard_ids
+        self._names = NameDictionary([name for name, ids in names])
+        self._offsets = offsets
+        self._loaded = {}
+        self._lru = []
+
+        if self._debug:  # profiling
+            timing = (time.time() - timing) * 1000
+            print "[ctags] manifest: %.02fms" % timing
+
+    def _load_shard(self, shard_id, cache=True):
+        """
+        Get shard tags, load it if needed
+
+        Shard loaded without cache is not kept in loaded shards.
+        """
+        tags = self._loaded.get(shard_id)
+        if tags is not None:
+            # mark shard as recently used
+            self._lru.remove(shard_id)
+            self._lru.append(shard_id)
+            return tags
+
+        path, recursive, filename, count = self._shards[shard_id]
+        tags = CTags(tags_file=os.path.join(self._shards_dir, filename),
+                     roots=self._roots, debug=self._debug)
+        if not cache:
+            return tags
+
+        self._loaded[shard_id] = tags
+        self._lru.append(shard_id)
+
+        # evict least recently used shards if too many tags are loaded
+        loaded = sum(self._shards[i][3] for i in self._lru)
+        while loaded > self._cache_size and len(self._lru) > 1:
+            evicted = self._lru.pop(0)
+            del self._loaded[evicted]
+            loaded -= self._shards[evicted][3]
+
+        return tags
+
+    def _lookup(self, symbol=None):
+        """
+        Find all definitions of symbol in shards, all tags if no symbol
+        """
+        if symbol is None:
+            # all tags are needed, don't churn loaded shards cache with it
+            definitions = []
+            for shard_id in xrange(len(self._shards)):
+                tags = self._load_shard(shard_id, cache=False)
+                definitions.extend(tags._lookup())
+            return definitions
+
+        index = self._names.find(symbol)
+        if index == -1:
+            return []
+        shard_ids = self._shard_ids[
+            self._offsets[index]:self._offsets[index + 1]
+        ]
+
+        definitions = []
+        for shard_id in shard_ids:
+            definitions.extend(self._load_shard(shard_id)._lookup(symbol))
+        return definitions
+
+    def _file_index(self, filename, load=True):
+        """
+        Get shard with tags of given file, load it if needed
+        """
+        shard_id = self._shard_index.get(get_shard(filename, self._roots))
+        if shard_id is not None and (load or shard_id in self._loaded):
+            tags = self._load_shard(shard_id)
+            if filename in tags._files:
+                return tags
+
+        # file may be from third-party package
+        return super(ShardedCTags, self)._file_index(filename, load)
+
+    def _replace(self, tag, updated):
+        """
+        Replace tag in its shard
+        """
+        shard_id = self._shard_index.get(get_shard(tag[1], self._roots))
+        if shard_id is None:
+            return False
+
+        # tag may be from shard loaded without cache, load shard to keep
+        # the fix in index
+        return self._load_shard(shard_id)._replace(tag, updated)
+
+
+class PackageCTags(CTags):
+    """
+    Work with third-party package tags, tags are loaded on demand
+    """
+
+    def __init__(self, tags_file=None, base_dir=None, files=(),
+                 debug=False):
+        """
+        Initialize, load names only if package names file exists
+        """
+        super(PackageCTags, self).__init__(roots=[base_dir],
+                                           base_dir=base_dir, debug=debug)
+
+        # package python files, relative to package dir
+        self._package_files = frozenset(os.path.join(base_dir, f)
+                                        for f in files)
+        self._tags_file = tags_file
+        self._loaded = False
+
+        try:
+            # names are stored next to tags file
+            self._names = NameDictionary(read_names(tags_file + '.names'))
+        except IOError:
+            # cache built without names file
+            self._load()
+
+    def _load(self):
+        """
+        Load package tags if not loaded yet
+        """
+        if not self._loaded:
+            self._loaded = True
+            self.load_file(self._tags_file)
+
+    def _lookup(self, symbol=None):
+        """
+        Find all definitions of symbol, load tags only if symbol is known
+        """
+        if symbol is not None and not self._loaded and \
+                self._names.find(symbol) == -1:
+            return []
+
+        self._load()
+        return super(PackageCTags, self)._lookup(symbol)
+
+    def _file_index(self, filename, load=True):
+        """
+        Get index with tags of given package file, load it if needed
+        """
+        if filename not in self._package_files:
+            return None
+        if not load and not self._loaded:
+            return None
+
+        self._load()
+        return super(PackageCTags, self)._file_index(filename, load)
+
+    def _replace(self, tag, updated):
+        """
+        Replace tag in loaded package tags
+        """
+        if not self._loaded:
+            return False
+        return super(PackageCTags, self)._replace(tag, updated)
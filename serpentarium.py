@@ -4,6 +4,7 @@ Serpentarium is a Sublime Text 2 plugin for work with ctags in Python files.
 """
 import os
 import re
+import csv
 import time
 import json
 import tempfile
@@ -14,7 +15,9 @@ import subprocess
 import sublime
 import sublime_plugin
 
-from ctags import CTags
+from ctags import CTags, ShardedCTags, PackageCTags, get_shard, \
+    is_manifest, read_manifest, write_manifest, write_names, split_tags, \
+    scan_source
 
 settings = sublime.load_settings("Serpentarium.sublime-settings")
 is_debug = lambda: settings.get('debug', False)
@@ -22,6 +25,22 @@ is_debug = lambda: settings.get('debug', False)
 ctags = None
 history = []
 
+# every tags build gets its own generation number, shards files of all
+# generations live together, so numbers must not repeat after restart
+last_generation = 0
+
+# loaded third-party packages tags, by cache file and install dir: cache
+# file is shared by projects, but loaded tags have absolute paths
+packages = {}
+
+# found distributions, by dir: dir modification time and distributions
+distributions = {}
+
+# tags of unsaved buffers, by view id: view, file name, tags and is it saved
+overlays = {}
+# buffers modifications counters, by view id
+changes = {}
+
 
 def threaded(finish=None, msg="Thread already running"):
     """
@@ -60,6 +79,175 @@ def threaded(finish=None, msg="Thread already running"):
     return decorator
 
 
+def publish(staging, target):
+    """
+    Atomically replace target file with staging file
+    """
+    try:
+        os.rename(staging, target)
+    except OSError:
+        # windows can't rename over existing file
+        if not os.path.exists(target):
+            raise
+        os.unlink(target)
+        os.rename(staging, target)
+
+
+def next_generation(target):
+    """
+    Get new generation number, greater than generations of all existing
+    staging and shards files of target
+    """
+    global last_generation
+
+    # staging files are named "<target>.<generation>", shards files are
+    # named "<shard>.<generation>.ctags"
+    names = []
+    dirname, basename = os.path.split(target)
+    if os.path.isdir(dirname or os.curdir):
+        names.extend(filename for filename in os.listdir(dirname or os.curdir)
+                     if os.path.splitext(filename)[0] == basename)
+    shards_dir = target + '.shards'
+    if os.path.isdir(shards_dir):
+        names.extend(os.path.splitext(filename)[0]
+                     for filename in os.listdir(shards_dir))
+
+    largest = last_generation
+    for name in names:
+        ext = os.path.splitext(name)[1][1:]
+        if ext.isdigit():
+            largest = max(largest, int(ext))
+
+    # generations follow build time, unless clock went backwards
+    last_generation = max(largest + 1, int(time.time()))
+    return last_generation
+
+
+def collect_generations(target, generation):
+    """
+    Remove staging and shards files of old tags generations
+    """
+    def is_old(ext):
+        return ext[1:].isdigit() and int(ext[1:]) <= generation
+
+    dirname, basename = os.path.split(target)
+    for filename in os.listdir(dirname):
+        # staging files are named "<target>.<generation>"
+        name, ext = os.path.splitext(filename)
+        if name != basename or not is_old(ext):
+            continue
+
+        try:
+            os.unlink(os.path.join(dirname, filename))
+        except OSError:
+            pass
+
+    # shards files are named "<shard>.<generation>.ctags"
+    shards_dir = target + '.shards'
+    if not os.path.isdir(shards_dir) or not is_manifest(target):
+        return
+    shards, _ = read_manifest(target, with_names=False)
+    used = set(shard[2] for shard in shards)
+
+    for filename in os.listdir(shards_dir):
+        name, ext = os.path.splitext(os.path.splitext(filename)[0])
+        if filename in used or not is_old(ext):
+            continue
+
+        try:
+            os.unlink(os.path.join(shards_dir, filename))
+        except OSError:
+            pass
+
+
+def find_distributions(dirname):
+    """
+    Find distributions installed in dir: name, version and python files
+    """
+    # dir modification time is changed on package install or removal
+    mtime = os.stat(dirname).st_mtime
+    cached = distributions.get(dirname)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+
+    result = []
+    for entry in sorted(os.listdir(dirname)):
+        info_dir = os.path.join(dirname, entry)
+        if not os.path.isdir(info_dir):
+            continue
+
+        files = []
+        if entry.endswith('.dist-info'):
+            # "<name>-<version>.dist-info", files are listed in RECORD
+            name, _, version = entry[:-len('.dist-info')].partition('-')
+            try:
+                with open(os.path.join(info_dir, 'RECORD'), 'rb') as f:
+                    files = [row[0] for row in csv.reader(f) if row]
+            except IOError:
+                pass
+        elif entry.endswith('.egg-info'):
+            # "<name>-<version>[-py<X.Y>].egg-info", files are listed
+            # relative to egg-info dir in installed-files.txt
+            name, _, version = entry[:-len('.egg-info')].partition('-')
+            version = version.split('-')[0]
+            try:
+                with open(os.path.join(info_dir, 'installed-files.txt')) as f:
+                    files = [os.path.join(entry, l.strip()) for l in f]
+            except IOError:
+                pass
+        else:
+            continue
+
+        if not name or not version:
+            continue
+
+        # skip files outside of dir (scripts, data) and non-python files
+        files = [os.path.normpath(f) for f in files if f.endswith('.py')]
+        files = [f for f in files if not f.startswith(os.pardir)]
+        if files:
+            result.append((name, version, files))
+
+    distributions[dirname] = (mtime, result)
+    return result
+
+
+def find_packages(dirs, cache_dir):
+    """
+    Find third-party distributions installed in dirs, with its tags cache
+    """
+    result = []
+    for dirname in dirs:
+        if not os.path.isdir(dirname):
+            continue
+
+        for name, version, files in find_distributions(dirname):
+            # package tags are cached by distribution name and version
+            cache = re.sub(r'[^\w.+-]+', '_', "%s-%s" % (name, version))
+            result.append({
+                "name": name,
+                "version": version,
+                "dir": dirname,
+                "files": files,
+                "cache": os.path.join(cache_dir, cache + '.ctags'),
+            })
+    return result
+
+
+def load_package(package):
+    """
+    Get third-party package tags, tags are loaded from package cache on
+    first lookup which needs it
+    """
+    key = (package['cache'], package['dir'])
+    tags = packages.get(key)
+    if tags is None:
+        tags = PackageCTags(tags_file=package['cache'],
+                            base_dir=package['dir'], files=package['files'],
+                            debug=is_debug)
+        packages[key] = tags
+    return tags
+
+
 class Serpentarium(object):
     """
     Serpentarium base class
@@ -203,21 +391,149 @@ class Serpentarium(object):
         view.window().open_file("%s:%d:%d" % (filename, row, col),
                                 sublime.ENCODED_POSITION)
 
-    def prettify_path(self, path):
+    def get_project_roots(self, path=None):
         """
-        Makes file path nice to show to user.
+        Get project dir and include dirs, used to prettify tags paths
         """
-        # assuming it's our project path
-        try:
-            project_path = self._project_path
-        except AttributeError:
-            self._project_path = os.path.dirname(self.get_config_file())
-            project_path = self._project_path
+        config_file = self.get_config_file(path)
+        if config_file is None:
+            return []
+        config_dir = os.path.dirname(config_file)
 
-        if path.startswith(project_path):
-            # + 1 for slash
-            path = path[len(project_path) + 1:]
-        return path
+        roots = [config_dir]
+        config = self.parse_config(path) or {}
+        for d in config.get('include_dirs', ()):
+            roots.append(os.path.normpath(os.path.join(config_dir, d)))
+        return roots
+
+    def get_package_dirs(self, path=None):
+        """
+        Get project include dirs, where third-party distributions are
+        searched, and shared packages tags cache dir
+        """
+        cache_dir = settings.get('packages_cache_dir') or os.path.join(
+            sublime.packages_path(), 'User', 'Serpentarium.cache'
+        )
+
+        config_file = self.get_config_file(path)
+        if config_file is None:
+            return [], cache_dir
+        config_dir = os.path.dirname(config_file)
+
+        config = self.parse_config(path) or {}
+        dirs = [os.path.normpath(os.path.join(config_dir, d))
+                for d in config.get('include_dirs', ())]
+        return dirs, cache_dir
+
+    def get_packages(self, path=None):
+        """
+        Get third-party distributions installed in project include dirs
+        """
+        return find_packages(*self.get_package_dirs(path))
+
+    def get_ctags(self, path=None):
+        """
+        Get loaded ctags, load it from ctags file if needed
+        """
+        # check ctags is exists
+        ctags_file = self.get_ctags_file(path)
+        if ctags_file is None or not os.path.exists(ctags_file):
+            return None
+
+        # check ctags is prepared - prepare if needed
+        global ctags
+        if ctags is None:
+            if is_manifest(ctags_file):
+                ctags = ShardedCTags(
+                    tags_file=ctags_file,
+                    roots=self.get_project_roots(path),
+                    cache_size=settings.get('shards_cache_size', 500000),
+                    debug=is_debug
+                )
+            else:
+                # tags file built before sharding
+                ctags = CTags(tags_file=ctags_file,
+                              roots=self.get_project_roots(path),
+                              debug=is_debug)
+
+            # add already cached third-party packages
+            for package in self.get_packages(path):
+                if os.path.exists(package['cache']):
+                    ctags.add_package(load_package(package))
+        return ctags
+
+    def get_overlay(self, filename):
+        """
+        Get unsaved buffer tags for file
+        """
+        for overlay in overlays.values():
+            if overlay['file'] == filename:
+                return overlay['tags']
+        return None
+
+    def get_definitions(self, ctags, symbol=None):
+        """
+        Find definitions in unsaved buffers first, then in project tags
+        """
+        definitions = []
+        for overlay in overlays.values():
+            definitions.extend(overlay['tags'].get_definitions(symbol))
+
+        # project tags of unsaved buffers files are outdated
+        files = set(overlay['file'] for overlay in overlays.values())
+        definitions.extend(d for d in ctags.get_definitions(symbol)
+                           if d[1] not in files)
+        return definitions
+
+    def autocomplete(self, ctags, prefix):
+        """
+        Autocomplete with unsaved buffers and project tags
+        """
+        completions = ctags.autocomplete(prefix)
+        if overlays:
+            completions = set(completions)
+            for overlay in overlays.values():
+                completions.update(overlay['tags'].autocomplete(prefix))
+            completions = sorted(completions)
+        return completions
+
+    def reanchor(self, definition):
+        """
+        Fix definition line if file was changed after tags build
+        """
+        # unsaved buffer tags are actual and file on disk is not
+        if self.get_overlay(definition[1]) is not None:
+            return definition
+        return self._ctags.reanchor(definition)
+
+    def show_definitions(self, window, offset=0):
+        """
+        Show definitions list in quick panel, page by page
+        """
+        page_size = settings.get('quick_panel_page_size', 1000)
+
+        # display rows are prepared by ctags, just take current page
+        page = self._definitions[offset:offset + page_size]
+        definitions = [list(d[5]) for d in page]
+
+        rest = len(self._definitions) - offset - len(page)
+        if rest > 0:
+            definitions.append(["more...", "%d definitions left" % rest])
+
+        def on_done(choose):
+            if choose == -1:
+                return self.select_definition(-1)
+
+            if choose == len(page):
+                # "more..." row selected - show next page
+                # (quick panel can't be reopened from its own callback)
+                return sublime.set_timeout(functools.partial(
+                    self.show_definitions, window, offset + len(page)
+                ), 10)
+
+            self.select_definition(offset + choose)
+
+        window.show_quick_panel(definitions, on_done)
 
 
 class SerpentariumSetupCommand(sublime_plugin.WindowCommand, Serpentarium):
@@ -272,9 +588,9 @@ class SerpentariumRebuildCommand(sublime_plugin.WindowCommand, Serpentarium):
         # check if any file is open
         return bool(self.window.active_view())
 
-    def run(self, paths=None, silent=False):
+    def run(self, paths=None, silent=False, changed=None):
         """
-        Run build command
+        Run build command, rebuild only shards of changed files if given
         """
         # check if any work needs to be done
         if not settings.get('ctags_enabled'):
@@ -315,12 +631,17 @@ class SerpentariumRebuildCommand(sublime_plugin.WindowCommand, Serpentarium):
             "cmd": settings.get('ctags_cmd'),
             "args": settings.get('ctags_args'),
             "out": self.get_ctags_file(path),
+            "roots": self.get_project_roots(path),
+            "cache_size": settings.get('shards_cache_size', 500000),
+            "pipe": settings.get('ctags_pipe', True),
         }
 
-        # run build process
-        self.build_tags(folders, ctags, silent)
+        # run build process, distributions are searched in build thread
+        self.build_tags(folders, ctags, self.get_package_dirs(path), changed,
+                        silent)
 
-    def build_is_done(self, is_ok=False, tags=None, silent=False, timing=None):
+    def build_is_done(self, is_ok=False, tags=None, silent=False, timing=None,
+                      out=None, generation=0, changed=None):
         """
         Build tags is over - cleanup
         """
@@ -328,9 +649,23 @@ class SerpentariumRebuildCommand(sublime_plugin.WindowCommand, Serpentarium):
             print "[total] rebuild: %.02fms" % (timing * 1000)
 
         if is_ok:
-            # tags rebuilded
+            # tags rebuilded - swap index, unless newer one is loaded already
             global ctags
-            ctags = tags
+            if ctags is None or ctags.generation < tags.generation:
+                ctags = tags
+
+            # saved buffers are in tags now, drop its overlays, full
+            # rebuild covers all buffers, which are not modified
+            for view_id, overlay in overlays.items():
+                if changed:
+                    outdated = overlay['saved'] and \
+                        overlay['file'] in changed
+                else:
+                    outdated = overlay['saved'] or \
+                        not overlay['view'].is_dirty()
+                if outdated:
+                    del overlays[view_id]
+
             if not silent:
                 sublime.status_message('Tags rebuilded')
         else:
@@ -339,47 +674,202 @@ class SerpentariumRebuildCommand(sublime_plugin.WindowCommand, Serpentarium):
                 'Tags NOT rebuilded! See console for more information.'
             )
 
+        # previous index is not referenced anymore - drop its leftovers
+        if out is not None:
+            collect_generations(out, generation)
+
     @threaded(finish=build_is_done, msg="Build process is running already")
-    def build_tags(self, folders=None, ctags=None, silent=False):
+    def build_tags(self, folders=None, ctags=None, package_dirs=None,
+                   changed=None, silent=False):
         """
         Do build tags hard work in thread
         """
         timing = time.time()  # profiling
 
-        # create temporary file for python files list
+        # third-party distributions in include dirs
+        packages = find_packages(*package_dirs) if package_dirs else []
+
+        # tags are built into staging manifest and new shards files,
+        # current tags are untouched
+        generation = next_generation(ctags['out'])
+        staging = "%s.%d" % (ctags['out'], generation)
+        shards_dir = ctags['out'] + '.shards'
+
+        # create temporary files for python files list and ctags output
         tmpfile = tempfile.NamedTemporaryFile(delete=False).name
+        tagsfile = None
+        if not ctags['pipe']:
+            tagsfile = tempfile.NamedTemporaryFile(delete=False).name
 
-        # find all python files and save the list into temporary file
-        cmd = "find '%s' -type f -name '*.py' > '%s'" % ("' '".join(folders),
-                                                         tmpfile)
-        p = subprocess.Popen(cmd, shell=1, stdout=subprocess.PIPE,
-                             stderr=subprocess.STDOUT)
-        ret = p.wait()
-        if ret:
-            raise EnvironmentError((cmd, ret, p.stdout.read()))
-
-        if ctags is not None:
-            # build ctags
+        try:
+            if changed and is_manifest(ctags['out']):
+                # rebuild only shards of changed files, keep the rest
+                shards, names = read_manifest(ctags['out'])
+                names = dict((name, set(ids)) for name, ids in names)
+
+                targets = set(get_shard(f, ctags['roots']) for f in changed)
+                removed = set()
+                for i, shard in enumerate(shards):
+                    if shard[:2] in targets:
+                        shards[i] = None
+                        removed.add(i)
+                for ids in names.itervalues():
+                    ids.difference_update(removed)
+
+                searches = [
+                    "'%s'%s" % (d, '' if recursive else ' -maxdepth 1')
+                    for d, recursive in targets if os.path.isdir(d)
+                ]
+            else:
+                shards, names = [], {}
+                searches = ["'%s'" % "' '".join(folders)]
+
+            # find all python files and save the list into temporary file
+            cmd = "(%s) > '%s'" % (
+                '; '.join("find %s -type f -name '*.py'" % d
+                          for d in searches) or 'true',
+                tmpfile,
+            )
+            p = subprocess.Popen(cmd, shell=1, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT)
+            ret = p.wait()
+            if ret:
+                raise EnvironmentError((cmd, ret, p.stdout.read()))
+
+            # third-party packages files are tagged separately
+            if packages:
+                owned = set()
+                for package in packages:
+                    owned.update(os.path.join(package['dir'], f)
+                                 for f in package['files'])
+                with open(tmpfile) as f:
+                    files = [l for l in f if l.rstrip('\n') not in owned]
+                with open(tmpfile, 'w') as f:
+                    f.writelines(files)
+
+            if ctags['pipe']:
+                # ctags writes unsorted tags to stdout and they are split
+                # into shards while ctags is still working, ctags is run
+                # without shell so it can be killed
+                cmd = [ctags['cmd']] + list(ctags['args']) + [
+                    '--fields=+nz', '--sort=no', '-L', tmpfile, '-f', '-'
+                ]
+                errors = tempfile.TemporaryFile()
+                p = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                     stderr=errors)
+                ret = None
+                try:
+                    split_tags(p.stdout, shards_dir, ctags['roots'],
+                               generation, shards, names)
+                    ret = p.wait()
+                    if ret:
+                        errors.seek(0)
+                        raise EnvironmentError((cmd, ret, errors.read()))
+                finally:
+                    # nobody reads ctags output anymore, don't leave it
+                    # blocked on the pipe
+                    p.stdout.close()
+                    if ret is None:
+                        try:
+                            p.kill()
+                        except OSError:
+                            pass
+                        p.wait()
+                    errors.close()
+            else:
+                # build ctags
+                cmd = "%s %s --fields=+nz -L '%s' -f '%s'" % (
+                    ctags['cmd'],
+                    ' '.join(ctags['args']),
+                    tmpfile,
+                    tagsfile,
+                )
+                p = subprocess.Popen(cmd, shell=1, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT)
+                ret = p.wait()
+                if ret:
+                    raise EnvironmentError((cmd, ret, p.stdout.read()))
+
+                # split builded ctags file into shards
+                with open(tagsfile) as f:
+                    split_tags(f, shards_dir, ctags['roots'], generation,
+                               shards, names)
+
+            # write manifest
+            write_manifest(staging, shards, names)
+
+            # load new manifest, shards are loaded on demand
+            tags = ShardedCTags(
+                roots=ctags['roots'],
+                generation=generation,
+                cache_size=ctags['cache_size'],
+                debug=is_debug
+            )
+            if tags.load_file(staging, shards_dir) is False:
+                raise EnvironmentError("Can't read tags file %s" % staging)
+
+            # add third-party packages, tag it once if not cached yet
+            for package in packages:
+                if not os.path.exists(package['cache']):
+                    self.build_package(ctags, package)
+                tags.add_package(load_package(package))
+
+            # publish new generation, nothing can fail after this point,
+            # otherwise previous tags shards would be collected
+            publish(staging, ctags['out'])
+        except EnvironmentError, e:
+            print "[%s] %s" % (__name__, e)
+            return (False, None, silent, (time.time() - timing),
+                    ctags['out'], generation, changed)
+        finally:
+            # remove temporary files
+            for filename in (tmpfile, tagsfile):
+                if filename is not None and os.path.exists(filename):
+                    os.unlink(filename)
+
+        return (True, tags, silent, (time.time() - timing),
+                ctags['out'], generation, changed)
+
+    def build_package(self, ctags, package):
+        """
+        Build third-party package tags into shared package cache
+        """
+        cache_dir = os.path.dirname(package['cache'])
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+        # package files list, relative to package dir
+        f = tempfile.NamedTemporaryFile(delete=False)
+        f.write('\n'.join(package['files']))
+        f.close()
+        tmpfile = f.name
+
+        staging = "%s.%d" % (package['cache'],
+                             next_generation(package['cache']))
+        try:
+            # tags file paths are relative to package dir, so same package
+            # version cache is shared by all projects
             cmd = "%s %s --fields=+nz -L '%s' -f '%s'" % (
                 ctags['cmd'],
                 ' '.join(ctags['args']),
                 tmpfile,
-                ctags['out'],
+                staging,
             )
-            p = subprocess.Popen(cmd, shell=1, stdout=subprocess.PIPE,
+            p = subprocess.Popen(cmd, shell=1, cwd=package['dir'],
+                                 stdout=subprocess.PIPE,
                                  stderr=subprocess.STDOUT)
             ret = p.wait()
             if ret:
                 raise EnvironmentError((cmd, ret, p.stdout.read()))
 
-        # parse builded ctags file
-        tags = CTags(tags_file=ctags['out'], debug=is_debug)
-
-        # remove temporary file
-        if tmpfile is not None and os.path.exists(tmpfile):
-            os.unlink(tmpfile)
-
-        return True, tags, silent, (time.time() - timing)
+            # names file is published first, so cached tags always have it
+            write_names(staging + '.names', staging)
+            publish(staging + '.names', package['cache'] + '.names')
+            publish(staging, package['cache'])
+        finally:
+            for filename in (tmpfile, staging, staging + '.names'):
+                if os.path.exists(filename):
+                    os.unlink(filename)
 
 
 class SerpentariumJumpToDefinition(sublime_plugin.TextCommand, Serpentarium):
@@ -415,21 +905,17 @@ class SerpentariumJumpToDefinition(sublime_plugin.TextCommand, Serpentarium):
         if not self.view.match_selector(0, 'source.python'):
             return
 
-        # check ctags is exists
-        ctags_file = self.get_ctags_file(self.view.file_name())
-        if ctags_file is None or not os.path.exists(ctags_file):
-            return []
-
         # check ctags is prepared - prepare if needed
-        global ctags
+        ctags = self.get_ctags(self.view.file_name())
         if ctags is None:
-            ctags = CTags(tags_file=ctags_file, debug=is_debug)
+            return []
 
         # get word under cursor
         symbol = self.view.substr(self.view.word(self.view.sel()[0]))
 
         # get all definitions of selected word
-        self._definitions = ctags.get_definitions(symbol)
+        self._ctags = ctags
+        self._definitions = self.get_definitions(ctags, symbol)
         if not self._definitions:
             return sublime.status_message("Can't find '%s'" % symbol)
 
@@ -440,13 +926,7 @@ class SerpentariumJumpToDefinition(sublime_plugin.TextCommand, Serpentarium):
             self.select_definition(0)
         else:
             # else show definitions list
-            definitions = [[
-                d[3][2:-4].strip(),
-                "%d: %s" % (d[2], self.prettify_path(d[1]))
-            ] for d in self._definitions]
-
-            self.view.window().show_quick_panel(definitions,
-                                                self.select_definition)
+            self.show_definitions(self.view.window())
 
     def select_definition(self, choose):
         """
@@ -459,15 +939,46 @@ class SerpentariumJumpToDefinition(sublime_plugin.TextCommand, Serpentarium):
         row, col = self.view.rowcol(self.view.sel()[0].begin())
         history.append((self.view.file_name(), row + 1, col + 1))
 
+        # check definition line is actual, tags may be built before edits
+        definition = self.reanchor(self._definitions[choose])
+        self._definitions[choose] = definition
+
         # jump to definition
         self.goto_file(
             view=self.view,
-            filename=self._definitions[choose][1],
-            row=self._definitions[choose][2],
+            filename=definition[1],
+            row=definition[2],
             col=0
         )
 
 
+class SerpentariumFileSymbols(SerpentariumJumpToDefinition):
+    """
+    Show all definitions in current file
+    """
+    def run(self, edit):
+        """
+        Run command - show current file definitions list
+        """
+        # skip non-python files
+        if not self.view.match_selector(0, 'source.python'):
+            return
+
+        # check ctags is prepared - prepare if needed
+        ctags = self.get_ctags(self.view.file_name())
+        if ctags is None:
+            return []
+
+        # get all definitions in current file, unsaved buffer goes first
+        self._ctags = ctags
+        index = self.get_overlay(self.view.file_name()) or ctags
+        self._definitions = index.get_file_symbols(self.view.file_name())
+        if not self._definitions:
+            return sublime.status_message("No definitions in current file")
+
+        self.show_definitions(self.view.window())
+
+
 class SerpentariumJumpBack(sublime_plugin.TextCommand, Serpentarium):
     """
     Jump back from definition
@@ -528,29 +1039,20 @@ class SerpentariumSearchDefinition(sublime_plugin.WindowCommand, Serpentarium):
         """
         Run command - open search for definition window
         """
-        # check ctags is exists
-        ctags_file = self.get_ctags_file(self.get_path(paths))
-        if ctags_file is None or not os.path.exists(ctags_file):
-            return []
-
         # check ctags is prepared - prepare if needed
-        global ctags
+        ctags = self.get_ctags(self.get_path(paths))
         if ctags is None:
-            ctags = CTags(tags_file=ctags_file, debug=is_debug)
+            return []
 
         # get all definitions of selected word
-        self._definitions = ctags.get_definitions()
+        self._ctags = ctags
+        self._definitions = self.get_definitions(ctags)
         if not self._definitions:
             # return sublime.status_message("Can't find '%s'" % symbol)
             return
 
         # else show definitions list
-        definitions = [[
-            d[3][2:-4].strip(),
-            "%d: %s" % (d[2], self.prettify_path(d[1]))
-        ] for d in self._definitions]
-
-        self.window.show_quick_panel(definitions, self.select_definition)
+        self.show_definitions(self.window)
 
     def select_definition(self, choose):
         """
@@ -564,11 +1066,15 @@ class SerpentariumSearchDefinition(sublime_plugin.WindowCommand, Serpentarium):
         row, col = view.rowcol(view.sel()[0].begin())
         history.append((view.file_name(), row + 1, col + 1))
 
+        # check definition line is actual, tags may be built before edits
+        definition = self.reanchor(self._definitions[choose])
+        self._definitions[choose] = definition
+
         # jump to definition
         self.goto_file(
             view=view,
-            filename=self._definitions[choose][1],
-            row=self._definitions[choose][2],
+            filename=definition[1],
+            row=definition[2],
             col=0
         )
 
@@ -677,10 +1183,107 @@ class SerpentariumBackground(sublime_plugin.EventListener, Serpentarium):
         if not view.match_selector(0, 'source.python'):
             return
 
+        # unsaved buffer tags are used until saved file is rebuilded
+        changes.pop(view.id(), None)
+        if view.id() in overlays:
+            overlays[view.id()]['saved'] = True
+
         if not settings.get('ctags_rebuild_on_save', False):
             return
 
-        view.window().run_command('serpentarium_rebuild', {'silent': True})
+        view.window().run_command('serpentarium_rebuild', {
+            'silent': True,
+            'changed': [view.file_name()],
+        })
+
+    def on_modified(self, view):
+        """
+        Rescan unsaved buffer definitions after a pause in typing
+        """
+        # skip non-python files and new files out of project
+        if not view.file_name() or \
+                not view.match_selector(0, 'source.python'):
+            return
+
+        change = changes.get(view.id(), 0) + 1
+        changes[view.id()] = change
+        sublime.set_timeout(
+            functools.partial(self.update_overlay, view, change),
+            settings.get('overlay_delay', 500)
+        )
+
+    def on_close(self, view):
+        """
+        Drop closed buffer tags
+        """
+        changes.pop(view.id(), None)
+        overlays.pop(view.id(), None)
+
+    def update_overlay(self, view, change):
+        """
+        Scan unsaved buffer and build its tags
+        """
+        # buffer is modified again or saved already
+        if changes.get(view.id()) != change:
+            return
+
+        # buffer is reverted to saved file, project tags are actual again
+        if not view.is_dirty():
+            overlays.pop(view.id(), None)
+            return
+
+        # check buffer is in project with tags
+        if self.get_ctags_file(view.file_name()) is None:
+            return
+
+        source = view.substr(sublime.Region(0, view.size()))
+        tags = CTags(roots=self.get_project_roots(view.file_name()),
+                     debug=is_debug)
+        tags.load_lines(scan_source(source, view.file_name()))
+
+        overlays[view.id()] = {
+            "view": view,
+            "file": view.file_name(),
+            "tags": tags,
+            "saved": False,
+        }
+
+    def on_selection_modified(self, view):
+        """
+        Show current enclosing definition in status bar
+        """
+        if not settings.get('show_enclosing_definition', True):
+            return
+
+        # skip non-python and unsaved new files
+        filename = view.file_name()
+        if not filename or not view.match_selector(0, 'source.python'):
+            return
+
+        # don't load tags or shards just for status bar
+        if ctags is None:
+            return
+
+        try:
+            row = view.rowcol(view.sel()[0].begin())[0]
+        except IndexError:
+            return
+
+        # cursor line indentation, blank lines belong to the code above
+        indent = 0
+        for line in xrange(row, -1, -1):
+            text = view.substr(view.line(view.text_point(line, 0)))
+            if text.strip():
+                text = text.expandtabs()
+                indent = len(text) - len(text.lstrip())
+                break
+
+        index = self.get_overlay(filename) or ctags
+        name = index.get_enclosing(filename, row + 1, indent, load=False)
+        if name:
+            view.set_status('serpentarium', "Definition: %s" % name)
+        else:
+            view.erase_status('serpentarium')
 
     def on_query_completions(self, view, prefix, locations):
         """
@@ -690,19 +1293,14 @@ class SerpentariumBackground(sublime_plugin.EventListener, Serpentarium):
         if not view.match_selector(0, 'source.python'):
             return []
 
-        # check ctags is exists
-        ctags_file = self.get_ctags_file(view.file_name())
-        if ctags_file is None or not os.path.exists(ctags_file):
-            return []
-
         # check ctags is prepared - prepare if needed
-        global ctags
+        ctags = self.get_ctags(view.file_name())
         if ctags is None:
-            ctags = CTags(tags_file=ctags_file, debug=is_debug)
+            return []
 
         # pt = locations[0] - len(prefix) - 1
         # ch = view.substr(sublime.Region(pt, pt + 1))
         # is_dot = (ch == '.')
 
         # do autocomplete work
-        return ctags.autocomplete(prefix)
+        return self.autocomplete(ctags, prefix)